@@ -1,7 +1,23 @@
 import os
-from openai import OpenAI
-
-client = OpenAI(api_key=os.environ['OPENAI_KEY'])
+import re
+import asyncio
+import argparse
+import hashlib
+import httpx
+import tiktoken
+from diskcache import Cache
+from openai import AsyncOpenAI
+
+# Maximum number of requests in flight at once
+max_concurrency = 20
+
+# One pooled client shared by every request so keep-alive connections are reused
+client = AsyncOpenAI(
+    api_key=os.environ['OPENAI_KEY'],
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+    )
+)
 
 system_prompt = """
 You are a summarization AI.
@@ -16,74 +32,177 @@ instruction_template = """
 The user query is:
 {query}
 
-The log of previous summaries is:
-{summaries}
-
 Now extract information from and summarize passage {page_number}/{total}:
 {passage}
 """
 
+compaction_template = """
+The user query is:
+{query}
+
+Now condense the following passage summaries into a single summary, keeping all information relevant to the user query:
+{summaries}
+"""
+
 # Read the full text of Shakespeare's works
 full_text = open("./data/google.txt").read()
 
-# Define the chunk size and split the text
-chunk_size = 2000  # Adjusted for demonstration purposes
-chunks = [full_text[i:i+chunk_size] for i in range(0, len(full_text), chunk_size)]
+# Define the chunk size in tokens and split the text on paragraph/sentence boundaries
+chunk_tokens = 3000
+encoding = tiktoken.encoding_for_model("gpt-4o")
+
+def split_pieces(paragraph, n_tokens):
+    # Paragraphs that do not fit in a chunk are split into sentences, and
+    # sentences that still do not fit are split on token boundaries
+    if n_tokens <= chunk_tokens:
+        return [(paragraph, n_tokens)]
+    pieces = []
+    for sentence in re.split(r'(?<=[.!?])(?=\s)', paragraph):
+        tokens = encoding.encode(sentence)
+        if len(tokens) <= chunk_tokens:
+            pieces.append((sentence, len(tokens)))
+        else:
+            for i in range(0, len(tokens), chunk_tokens):
+                piece = tokens[i:i+chunk_tokens]
+                pieces.append((encoding.decode(piece), len(piece)))
+    return pieces
+
+def split_into_chunks(text):
+    # Greedily pack paragraphs into chunks of up to chunk_tokens tokens
+    chunks = []
+    current = []
+    current_tokens = 0
+    for paragraph in text.split("\n\n"):
+        separator = "\n\n"
+        for piece, n_tokens in split_pieces(paragraph, len(encoding.encode(paragraph))):
+            if current and current_tokens + n_tokens > chunk_tokens:
+                chunks.append("".join(current))
+                current = []
+                current_tokens = 0
+            # Pieces of a split paragraph keep their own leading whitespace
+            current.append(separator + piece if current else piece.lstrip())
+            current_tokens += n_tokens
+            separator = ""
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+chunks = split_into_chunks(full_text)
 
 query = "What is the main driver of growth?"
 
-summaries = []
-
-def call_llm(system_prompt, instruction):
-    response = client.chat.completions.create(
-        model="gpt-4o",  # Use "gpt-4" if you have access
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": instruction}
-        ],
-        max_tokens=2000,  # Adjust as needed
-        temperature=0.2,
-    )
+parser = argparse.ArgumentParser()
+parser.add_argument("--no-cache", action="store_true", help="Ignore cached chunk summaries and call the API again")
+args = parser.parse_args()
+
+# Chunk summaries only depend on the query and the chunk text, so they can be reused across runs
+cache = Cache("./.sumcache")
+
+# Token budget for the summaries in the answer prompt; they are only compacted beyond it
+answer_tokens = 60000
+# Maximum number of summary tokens condensed by one compaction call
+compaction_tokens = 20000
+
+# Cap the number of in-flight requests to stay under the API rate limits
+semaphore = asyncio.Semaphore(max_concurrency)
+
+async def call_llm(system_prompt, instruction):
+    async with semaphore:
+        response = await client.chat.completions.create(
+            model="gpt-4o",  # Use "gpt-4" if you have access
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": instruction}
+            ],
+            max_tokens=2000,  # Adjust as needed
+            temperature=0.2,
+        )
     return response.choices[0].message.content
 
-for i, chunk in enumerate(chunks):
-    print(i,len(chunks))
-    summary_string = "\n".join(summaries)
+async def summarize_chunk(i, chunk):
+    key = hashlib.blake2b((query + "\x00" + chunk).encode(), digest_size=16).hexdigest()
+    if not args.no_cache and key in cache:
+        return cache[key]
     instruction = instruction_template.format(
         query=query,
-        summaries=summary_string,
         page_number=(i + 1),
         total=len(chunks),
         passage=chunk
     )
-    # Call the LLM to get the summary
-    summary = call_llm(system_prompt, instruction)
-    summaries.append(summary)
-    print(f"Processed chunk {i + 1}/{len(chunks)}")
-
-# Combine all summaries
-final_summary = "\n".join(summaries)
-
-f = open("summary.txt",'w')
-f.write(final_summary)
-f.close()
-
-# Now, use the final summary to answer the user's query
-answer_prompt = f"""
+    summary = await call_llm(system_prompt, instruction)
+    cache[key] = summary
+    return summary
+
+def pack_summaries(summaries):
+    # Greedily pack consecutive summaries into groups of up to compaction_tokens tokens
+    groups = []
+    current = []
+    current_tokens = 0
+    for summary in summaries:
+        n_tokens = len(encoding.encode(summary))
+        if current and current_tokens + n_tokens > compaction_tokens:
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        current.append(summary)
+        current_tokens += n_tokens
+    if current:
+        groups.append(current)
+    return groups
+
+async def compact_group(group):
+    text = "\n".join(group)
+    key = hashlib.blake2b(("compact\x00" + query + "\x00" + text).encode(), digest_size=16).hexdigest()
+    if not args.no_cache and key in cache:
+        return cache[key]
+    summary = await call_llm(system_prompt, compaction_template.format(query=query, summaries=text))
+    cache[key] = summary
+    return summary
+
+async def compact(summaries):
+    # Condense all groups concurrently, one round at a time, until the summaries fit the
+    # answer budget; most documents fit it directly and make no extra calls
+    while len(encoding.encode("\n".join(summaries))) > answer_tokens:
+        groups = pack_summaries(summaries)
+        if len(groups) == len(summaries):
+            break
+        summaries = await asyncio.gather(*[compact_group(group) for group in groups])
+    return "\n".join(summaries)
+
+async def main():
+    # Chunks are summarized independently so all requests can be in flight at once
+    tasks = [summarize_chunk(i, chunk) for i, chunk in enumerate(chunks)]
+    summaries = await asyncio.gather(*tasks)
+    print(f"Processed {len(chunks)} chunks")
+
+    # Combine all summaries
+    final_summary = "\n".join(summaries)
+
+    f = open("summary.txt",'w')
+    f.write(final_summary)
+    f.close()
+
+    # Keep the answer prompt within budget however many chunks there are
+    digest = await compact(summaries)
+
+    # Now, use the final summary to answer the user's query
+    answer_prompt = f"""
 Based on the following summaries, answer the user's query in detail:
 
 User Query:
 {query}
 
 Summaries:
-{final_summary}
+{digest}
 """
 
-# Get the final answer from the LLM
-final_answer = call_llm(system_prompt="", instruction=answer_prompt)
-print("Final Answer:")
-print(final_answer)
+    # Get the final answer from the LLM
+    final_answer = await call_llm(system_prompt="", instruction=answer_prompt)
+    print("Final Answer:")
+    print(final_answer)
+
+    f = open("answer.txt",'w')
+    f.write(final_answer)
+    f.close()
 
-f = open("answer.txt",'w')
-f.write(final_answer)
-f.close()
\ No newline at end of file
+asyncio.run(main())
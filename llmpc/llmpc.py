@@ -1,5 +1,7 @@
 import os
+import re
 from tools import CodeGenerator
+from templates import compile_template, render_template
 from openai import OpenAI
 
 system_prompt ="""
@@ -53,12 +55,23 @@ When using tools, wrap the tool call in <tool></tool> tags and format as JSON:
 Now please execute the plan.
 """
 
+# Matches numbered "<n>. <step>" lines in the planner output
+plan_step_pattern = re.compile(r'^\s*\d+\.\s*(.+?)\s*$', re.MULTILINE)
+
+parsed_system_prompt = compile_template(system_prompt)
+parsed_planner = compile_template(prompt_planner)
+parsed_executor = compile_template(prompt_executor)
+
 class LLMPC:
     def __init__(self, api_key: str, goal: str):
         self.generator = CodeGenerator(api_key)
         self.goal = goal
         self.actions = []
+        # Rendered actions log, extended incrementally instead of rebuilt per prompt
+        self.actions_string = ""
         self.context = ""
+        # Maps file path -> ((mtime_ns, size), rendered context block)
+        self.file_cache = {}
 
     def update_context(self):
         files_context = []
@@ -67,28 +80,40 @@ class LLMPC:
         if not os.path.exists(files_dir):
             return
             
-        for filename in os.listdir(files_dir):
-            file_path = os.path.join(files_dir, filename)
-            if os.path.isfile(file_path):
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                    numbered_lines = [f"{i} {line.rstrip()}" for i, line in enumerate(lines)]
-                    files_context.append(f"File: {filename}\n" + "\n".join(numbered_lines))
+        # Only re-read files whose modification time or size changed since the last call
+        file_cache = {}
+        for entry in os.scandir(files_dir):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            signature = (stat.st_mtime_ns, stat.st_size)
+            cached = self.file_cache.get(entry.path)
+            if cached and cached[0] == signature:
+                rendered = cached[1]
+            else:
+                with open(entry.path, 'r', encoding='utf-8') as f:
+                    rendered = f"File: {entry.name}\n" + "\n".join(
+                        f"{i} {line.rstrip()}" for i, line in enumerate(f)
+                    )
+            file_cache[entry.path] = (signature, rendered)
+            files_context.append(rendered)
+        self.file_cache = file_cache
         
         self.context = "\n\n".join(files_context)
 
-    def get_system_prompt(self, template: str, **kwargs) -> str:
+    def get_system_prompt(self, template: list, **kwargs) -> str:
         self.update_context()  # Update context before generating prompt
-        return template.format(
+        return render_template(
+            template,
             goal=self.goal,
-            actions="\n".join(f"- {action}" for action in self.actions),
+            actions=self.actions_string.lstrip("\n"),
             context=self.context,
             **kwargs
         ) 
 
     def plan(self, k: int = 3) -> list:
-        prompt = self.get_system_prompt(system_prompt)
-        instruction = prompt_planner.format(k=k)
+        prompt = self.get_system_prompt(parsed_system_prompt)
+        instruction = render_template(parsed_planner, k=k)
         print(prompt, instruction)
         response = self.generator.client.chat.completions.create(
             model="gpt-4o",
@@ -100,20 +125,19 @@ class LLMPC:
         
         # Extract plan steps from response
         content = response.choices[0].message.content
-        plan_section = content.split("PLAN:")[1].strip()
-        steps = []
-        for line in plan_section.split("\n"):
-            if line.strip() and line[0].isdigit():
-                steps.append(line.split(".", 1)[1].strip())
-        return steps
+        idx = content.find("PLAN:")
+        if idx == -1:
+            raise ValueError(f"Planner response has no PLAN: section:\n{content}")
+        return plan_step_pattern.findall(content[idx + len("PLAN:"):])
 
     def execute(self, plan: list) -> None:
         plan_string ="\n".join(f"{i+1}. {step}" for i, step in enumerate(plan))
-        prompt = self.get_system_prompt(system_prompt)
-        instruction = prompt_executor.format(plan=plan_string)
+        prompt = self.get_system_prompt(parsed_system_prompt)
+        instruction = render_template(parsed_executor, plan=plan_string)
         print(prompt, instruction)
         self.generator.generate(prompt, instruction)
         self.actions.extend(plan)
+        self.actions_string += "".join(f"\n- {step}" for step in plan)
 
 def main():
     api_key = os.getenv("OPENAI_KEY")
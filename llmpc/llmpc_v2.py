@@ -1,5 +1,8 @@
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
+from templates import compile_template, render_template
 
 system_prompt ="""
 You are an intelligent software engineering AI assistant.
@@ -54,12 +57,30 @@ Example:
 Now please execute the plan by providing the complete content for each file that needs to be created or modified.
 """
 
+# Matches ```<language> <filename> code blocks in the executor output
+code_block_pattern = re.compile(r'```(\w+)\s+([^\n]+)\n(.*?)```', re.DOTALL)
+# Matches numbered "<n>. <step>" lines in the planner output
+plan_step_pattern = re.compile(r'^\s*\d+\.\s*(.+?)\s*$', re.MULTILINE)
+
+parsed_system_prompt = compile_template(system_prompt)
+parsed_planner = compile_template(prompt_planner)
+parsed_executor = compile_template(prompt_executor)
+
+def write_file(filepath: str, content: str) -> None:
+    # Create or overwrite file
+    with open(filepath, 'w', encoding='utf-8') as f:
+        f.write(content)
+
 class LLMPC:
     def __init__(self, api_key: str, goal: str):
         self.client = OpenAI(api_key=api_key)
         self.goal = goal
         self.actions = []
+        # Rendered actions log, extended incrementally instead of rebuilt per prompt
+        self.actions_string = ""
         self.context = ""
+        # Maps file path -> ((mtime_ns, size), rendered context block)
+        self.file_cache = {}
 
     def update_context(self):
         files_context = []
@@ -68,28 +89,38 @@ class LLMPC:
         if not os.path.exists(files_dir):
             os.makedirs(files_dir)
             
-        for filename in os.listdir(files_dir):
-            file_path = os.path.join(files_dir, filename)
-            if os.path.isfile(file_path):
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                    #numbered_lines = [f"{i} {line.rstrip()}" for i, line in enumerate(lines)]
-                    files_context.append(f"File: {filename}\n" + "".join(lines))
+        # Only re-read files whose modification time or size changed since the last call
+        file_cache = {}
+        for entry in os.scandir(files_dir):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            signature = (stat.st_mtime_ns, stat.st_size)
+            cached = self.file_cache.get(entry.path)
+            if cached and cached[0] == signature:
+                rendered = cached[1]
+            else:
+                with open(entry.path, 'r', encoding='utf-8') as f:
+                    rendered = f"File: {entry.name}\n" + f.read()
+            file_cache[entry.path] = (signature, rendered)
+            files_context.append(rendered)
+        self.file_cache = file_cache
         
         self.context = "\n\n".join(files_context)
 
-    def get_system_prompt(self, template: str, **kwargs) -> str:
+    def get_system_prompt(self, template: list, **kwargs) -> str:
         self.update_context()  # Update context before generating prompt
-        return template.format(
+        return render_template(
+            template,
             goal=self.goal,
-            actions="\n".join(f"- {action}" for action in self.actions),
+            actions=self.actions_string.lstrip("\n"),
             context=self.context,
             **kwargs
         )
 
     def plan(self, k: int = 3) -> list:
-        prompt = self.get_system_prompt(system_prompt)
-        instruction = prompt_planner.format(k=k)
+        prompt = self.get_system_prompt(parsed_system_prompt)
+        instruction = render_template(parsed_planner, k=k)
         print(prompt,instruction)
         response = self.client.chat.completions.create(
             model="gpt-4",
@@ -104,17 +135,15 @@ class LLMPC:
         # Extract plan steps from response
         content = response.choices[0].message.content
         print(content)
-        plan_section = content.split("PLAN:")[1].strip()
-        steps = []
-        for line in plan_section.split("\n"):
-            if line.strip() and line[0].isdigit():
-                steps.append(line.split(".", 1)[1].strip())
-        return steps
+        idx = content.find("PLAN:")
+        if idx == -1:
+            raise ValueError(f"Planner response has no PLAN: section:\n{content}")
+        return plan_step_pattern.findall(content[idx + len("PLAN:"):])
 
     def execute(self, plan: list) -> None:
         plan_string = "\n".join(f"{i+1}. {step}" for i, step in enumerate(plan))
-        prompt = self.get_system_prompt(system_prompt)
-        instruction = prompt_executor.format(plan=plan_string)
+        prompt = self.get_system_prompt(parsed_system_prompt)
+        instruction = render_template(parsed_executor, plan=plan_string)
         print(prompt, instruction)
 
         response = self.client.chat.completions.create(
@@ -129,19 +158,18 @@ class LLMPC:
 
         content = response.choices[0].message.content
         print(content)
-        # Extract code blocks and save files
-        import re
-        code_blocks = re.finditer(r'```(\w+)\s+([^\n]+)\n(.*?)```', content, re.DOTALL)
-        
-        for block in code_blocks:
+        # Extract code blocks, keeping the last block when a file appears twice
+        writes = {}
+        for block in code_block_pattern.finditer(content):
             language, filename, code = block.groups()
-            filepath = os.path.join("files", filename)
-            
-            # Create or overwrite file
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(code.strip())
+            writes[os.path.join("files", filename)] = code.strip()
+
+        # The files are independent, so write them concurrently
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(write_file, writes.keys(), writes.values()))
 
         self.actions.extend(plan)
+        self.actions_string += "".join(f"\n- {step}" for step in plan)
 
 def main():
     api_key = os.getenv("OPENAI_KEY")
@@ -0,0 +1,18 @@
+import string
+
+formatter = string.Formatter()
+
+def compile_template(template: str) -> list:
+    # Parse the template once into (literal, field, format_spec, conversion) segments
+    parsed = list(formatter.parse(template))
+    for _, field, format_spec, _ in parsed:
+        if format_spec and "{" in format_spec:
+            raise ValueError(f"Nested replacement fields are not supported: {{{field}:{format_spec}}}")
+    return parsed
+
+def render_template(parsed: list, **kwargs) -> str:
+    # Apply each field's conversion (!r, !s, !a) and format spec the way str.format would
+    return "".join(
+        literal + (format(formatter.convert_field(kwargs[field], conversion), format_spec) if field is not None else "")
+        for literal, field, format_spec, conversion in parsed
+    )
@@ -1,59 +1,78 @@
 # Import necessary libraries
-import nltk
+import os
+import numpy as np
 import spacy
-from nltk.corpus import stopwords
-from gensim import corpora, models
-from rake_nltk import Rake
+from gensim import corpora
+from gensim.models import LdaMulticore
+from sklearn.feature_extraction.text import TfidfVectorizer
 
-# Download necessary NLTK data
-nltk.download('stopwords')
-nltk.download('punkt')
-
-# Set up stop words and spaCy model
-stop_words = set(stopwords.words('english'))
-nlp = spacy.load('en_core_web_sm')
+# spaCy model, loaded on first use so importing this module stays cheap
+nlp = None
 
 def classical_nlp_tagging(documents):
+    global nlp
+    if nlp is None:
+        nlp = spacy.load('en_core_web_sm')
     classical_tags = []
 
-    for doc in documents:
-        # Entity Extraction using spaCy
-        spacy_doc = nlp(doc)
-        entities = [(ent.text, ent.label_) for ent in spacy_doc.ents]
-        
-        # Keyword Extraction using RAKE
-        rake = Rake(stopwords=stop_words)
-        rake.extract_keywords_from_text(doc)
-        gensim_kw = rake.get_ranked_phrases()[:5]  # Get top 5 keywords
+    # Run spaCy once over all documents, batched across processes, and reuse
+    # its entities and lemmas for every tagging step below
+    entities = []
+    tokenized_docs = []
+    spacy_docs = nlp.pipe(
+        documents, batch_size=64, n_process=max(1, os.cpu_count() // 2),
+        disable=["parser"]
+    )
+    for spacy_doc in spacy_docs:
+        entities.append([(ent.text, ent.label_) for ent in spacy_doc.ents])
+        tokenized_docs.append([
+            token.lemma_.lower() for token in spacy_doc
+            if token.is_alpha and not token.is_stop
+        ])
+
+    # Topic Modeling using one LDA model trained over the whole corpus
+    dictionary = corpora.Dictionary(tokenized_docs)
+    corpus = [dictionary.doc2bow(tokens) for tokens in tokenized_docs]
+    lda_model = LdaMulticore(
+        corpus, num_topics=20, id2word=dictionary, passes=5, iterations=50,
+        workers=max(1, os.cpu_count() - 1)
+    )
+
+    # Keyword Extraction using TF-IDF weights over the same lemmatized tokens
+    vectorizer = TfidfVectorizer(
+        tokenizer=lambda tokens: tokens, preprocessor=lambda tokens: tokens,
+        lowercase=False, token_pattern=None, max_features=50000, ngram_range=(1, 2)
+    )
+    tfidf = vectorizer.fit_transform(tokenized_docs)
+    vocab = np.array(vectorizer.get_feature_names_out())
+
+    for doc, doc_entities, bow, row in zip(documents, entities, corpus, tfidf):
+        # Top 5 keywords, ranked over the non-zero entries of the sparse row
+        keywords = vocab[row.indices[np.argsort(-row.data)[:5]]].tolist()
         
-        # Topic Modeling using LDA
-        tokens = [
-            word for word in nltk.word_tokenize(doc.lower())
-            if word.isalpha() and word not in stop_words
+        # Topics inferred for this document from the corpus-level model
+        topics = [
+            (topic_id, lda_model.print_topic(topic_id, topn=3))
+            for topic_id, _ in lda_model.get_document_topics(bow)
         ]
-        dictionary = corpora.Dictionary([tokens])
-        corpus = [dictionary.doc2bow(tokens)]
-        lda_model = models.LdaModel(
-            corpus, num_topics=1, id2word=dictionary, passes=10, iterations=50
-        )
-        topics = lda_model.print_topics(num_words=3)
         
         # Collect the tags
         classical_tags.append({
             'document': doc,
-            'entities': entities,
-            'keywords': gensim_kw,
+            'entities': doc_entities,
+            'keywords': keywords,
             'topics': topics
         })
 
     return classical_tags
 
 # Example usage
-documents = [
-    "This paper explores the use of machine learning algorithms in predicting stock market trends.",
-    "The study investigates the impact of climate change on global agricultural production.",
-    "An analysis of quantum computing and its potential applications in cryptography.",
-    "A review of recent advancements in renewable energy technologies.",
-    "This research focuses on the social and economic effects of the COVID-19 pandemic.",
-]
-classical_tags = classical_nlp_tagging(documents)
\ No newline at end of file
+if __name__ == "__main__":
+    documents = [
+        "This paper explores the use of machine learning algorithms in predicting stock market trends.",
+        "The study investigates the impact of climate change on global agricultural production.",
+        "An analysis of quantum computing and its potential applications in cryptography.",
+        "A review of recent advancements in renewable energy technologies.",
+        "This research focuses on the social and economic effects of the COVID-19 pandemic.",
+    ]
+    classical_tags = classical_nlp_tagging(documents)
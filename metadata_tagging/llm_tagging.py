@@ -1,96 +1,376 @@
-import openai
+import argparse
+import asyncio
+import hashlib
 import json
 import os
-from rank_bm25 import BM25Okapi
+import re
+import httpx
+from diskcache import Cache
+from openai import AsyncOpenAI
+from pydantic import BaseModel, ConfigDict
+from tenacity import retry, retry_if_exception_type, stop_after_attempt
+import bm25s
+import Stemmer
 from datasets import load_dataset
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
 import numpy as np
+import scipy.sparse
+import torch
+from classical_tagging import classical_nlp_tagging
 
 MAX_DOCS = 20
+TAGGING_MODEL = "gpt-4o-mini"
+DOCS_PER_REQUEST = 8
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
 
-ds = load_dataset("okite97/news-data")
-titles = ds['train']['Title']
-texts = ds['train']['Excerpt']
-documents = [t for t in zip(titles, texts) if t[0] is not None and t[1] is not None]
-documents = [t[0] + ' ' + t[1] for t in documents][:MAX_DOCS]
-
-openai.api_key = os.environ['OPENAI_KEY']
-
-def llm_tagging(documents):
-    chatgpt_tags = []
-    for doc in documents:
-        prompt = (
-            f"Please provide the entities, keywords, topics, and categories for the following document:\n\n"
-            f"{doc}\n\n"
-            "Provide the answer as a JSON object with keys 'entities', 'keywords', 'topics', 'categories'."
-            "Only output the JSON object, do not use ```json tags."
+# Documents whose classical tags have at least this many entities + keywords skip the LLM
+MIN_CLASSICAL_SCORE = 7
+
+# LLM tags are deterministic for a given request, so they can be reused across runs
+cache = Cache("./.tagcache")
+# Same for sentence embeddings of a given (model, text) pair
+embedding_cache = Cache("./.embcache")
+
+# Maximum number of requests in flight at once
+MAX_CONCURRENCY = 50
+
+def create_client():
+    # One pooled HTTP/2 client shared by every request of a run so connections are
+    # reused; created inside the running event loop since its connections are bound to it
+    return AsyncOpenAI(
+        api_key=os.environ['OPENAI_KEY'],
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY)
+        )
+    )
+
+class Tags(BaseModel):
+    model_config = ConfigDict(extra='forbid')
+
+    entities: list[str]
+    keywords: list[str]
+    topics: list[str]
+    categories: list[str]
+
+class TagsList(BaseModel):
+    model_config = ConfigDict(extra='forbid')
+
+    items: list[Tags]
+
+# Constrain the model output to the tag schema server-side
+TAGS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "tags",
+        "strict": True,
+        "schema": TagsList.model_json_schema()
+    }
+}
+
+# Snowball stemmer shared by BM25 indexing and querying so both tokenize the same way
+stemmer = Stemmer.Stemmer("english")
+
+def tagging_request(docs):
+    # Several documents share one request to amortize the per-request overhead and the
+    # instruction tokens; the output format is given by the response schema
+    prompt = (
+        "Please provide the entities, keywords, topics, and categories for each of the following documents. "
+        "Return one item per document, in the same order.\n\n"
+        + "\n\n---\n\n".join(f"[{i}] {doc}" for i, doc in enumerate(docs))
+    )
+    return {
+        "model": TAGGING_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": 200 * len(docs),
+        "temperature": 0,
+        "response_format": TAGS_RESPONSE_FORMAT
+    }
+
+def parse_tags(docs, content):
+    items = TagsList.model_validate_json(content).items
+    if len(items) != len(docs):
+        raise ValueError(f"Expected tags for {len(docs)} documents, got {len(items)}")
+    return [{'document': doc, **tags.model_dump()} for doc, tags in zip(docs, items)]
+
+def group_documents(documents):
+    return [documents[i:i+DOCS_PER_REQUEST] for i in range(0, len(documents), DOCS_PER_REQUEST)]
+
+# The schema guarantees valid tags unless the response is cut off or skips a document.
+# A cut off response would only repeat at temperature 0 with the same max_tokens, so it
+# fails immediately; a skipped document raises ValueError and is retried
+@retry(retry=retry_if_exception_type(ValueError), stop=stop_after_attempt(3), reraise=True)
+async def tag_group(client, semaphore, docs):
+    async with semaphore:
+        response = await client.chat.completions.create(**tagging_request(docs))
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        raise RuntimeError(f"Tags for {len(docs)} documents were cut off at max_tokens")
+    return parse_tags(docs, choice.message.content)
+
+def cache_tags(group_tags):
+    for doc_tags in group_tags:
+        cache[request_key(doc_tags['document'])] = doc_tags
+
+async def tag_and_cache(client, semaphore, docs):
+    # Cache each group as soon as it is tagged so a later failure loses nothing already paid for
+    group_tags = await tag_group(client, semaphore, docs)
+    cache_tags(group_tags)
+    return group_tags
+
+def collect_groups(groups, results):
+    # A group that still fails after its retries only loses its own documents, returned as None
+    tags = []
+    for docs, group_tags in zip(groups, results):
+        if isinstance(group_tags, BaseException):
+            print(f"Tagging failed for {len(docs)} documents: {group_tags!r}")
+            group_tags = [None] * len(docs)
+        tags.extend(group_tags)
+    return tags
+
+async def llm_tagging(documents):
+    # Cap the number of in-flight requests to stay under the API rate limits
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    async with create_client() as client:
+        # Submit every request before awaiting any of them so they run concurrently
+        groups = group_documents(documents)
+        tasks = [tag_and_cache(client, semaphore, docs) for docs in groups]
+        return collect_groups(groups, await asyncio.gather(*tasks, return_exceptions=True))
+
+async def llm_tagging_batch(documents, poll_interval=30):
+    # Offline path through the Batch API, which is cheaper and not bound by per-request latency
+    groups = group_documents(documents)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    async with create_client() as client:
+        lines = [
+            json.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": tagging_request(docs)
+            })
+            for i, docs in enumerate(groups)
+        ]
+        batch_file = await client.files.create(
+            file=("llm_tagging.jsonl", "\n".join(lines).encode()),
+            purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
         )
-        response = openai.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=200,
-            temperature=0
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            print(f"Batch {batch.id}: {batch.status}")
+            await asyncio.sleep(poll_interval)
+            batch = await client.batches.retrieve(batch.id)
+        if batch.status == "failed":
+            # The input file was rejected, so none of the requests ran
+            raise RuntimeError(f"Batch {batch.id} failed: {batch.errors}")
+
+        # Expired or cancelled batches can still hold partial results, and the output
+        # file is missing entirely when no request succeeded
+        tags = {}
+        if batch.output_file_id is not None:
+            output = await client.files.content(batch.output_file_id)
+            for line in output.text.splitlines():
+                result = json.loads(line)
+                response = result.get("response")
+                if not response or response.get("status_code") != 200:
+                    continue
+                i = int(result["custom_id"])
+                try:
+                    tags[i] = parse_tags(groups[i], response["body"]["choices"][0]["message"]["content"])
+                except (ValueError, KeyError, IndexError, TypeError):
+                    continue
+                cache_tags(tags[i])
+
+        # Requests that failed, were cut off or never ran inside the batch are retried directly
+        missing = [i for i in range(len(groups)) if i not in tags]
+        retried = await asyncio.gather(
+            *[tag_and_cache(client, semaphore, groups[i]) for i in missing],
+            return_exceptions=True
         )
-        content = response.choices[0].message.content
-        try:
-            tags = json.loads(content)
-        except json.JSONDecodeError:
-            tags = {'entities': [], 'keywords': [], 'topics': [], 'categories': []}
-        
-        chatgpt_tags.append({
-            'document': doc,
-            'entities': tags.get('entities', []),
-            'keywords': tags.get('keywords', []),
-            'topics': tags.get('topics', []),
-            'categories': tags.get('categories', [])
-        })
-
-    return chatgpt_tags
-
-def bm25_search(documents, query, k=5):
-    tokenized_documents = [doc.split() for doc in documents]
-    bm25 = BM25Okapi(tokenized_documents)
-    tokenized_query = query.split()
-    scores = bm25.get_scores(tokenized_query)
-    top_indices = scores.argsort()[-k:][::-1]
-    return [(index, documents[index], scores[index]) for index in top_indices]
-
-def vector_search(model, document_embeddings, query_embedding, k=5):
-    scores = util.pytorch_cos_sim(query_embedding, document_embeddings)[0].cpu()
-    top_indices = np.argsort(-scores)[:k]
-    return [(index, scores[index]) for index in top_indices]
-
-chatgpt_tags = llm_tagging(documents)
-stringified_tags = [str(s) for s in chatgpt_tags]
-remove_chars = ["{", "}", ",", "'", ":", "[", "]"]
-stringified_tags = ["".join([c for c in s if c not in remove_chars]) for s in stringified_tags]
-
-query = "Football news"
-
-bm25_results_docs = bm25_search(documents, query)
-bm25_results_tags = bm25_search(stringified_tags, query)
-
-model = SentenceTransformer('all-MiniLM-L6-v2')
-
-doc_embeddings = model.encode(documents, convert_to_tensor=True)
-tag_embeddings = model.encode(stringified_tags, convert_to_tensor=True)
-query_embedding = model.encode(query, convert_to_tensor=True)
-
-vector_results_docs = vector_search(model, doc_embeddings, query_embedding)
-vector_results_tags = vector_search(model, tag_embeddings, query_embedding)
-
-print("BM25 NO TAGS")
-for index, doc, score in bm25_results_docs:
-    print(f"Document index: {index}, Score: {score}\n{doc}\n---\n")
-
-print("BM25 TAGS")
-for index, doc, score in bm25_results_tags:
-    print(f"Document index: {index}, Score: {score}\n{doc}\n---\n")
-
-print("VECTOR NO TAGS")
-for index, score in vector_results_docs:
-    print(f"Document index: {index}, Score: {score}\n{documents[index]}\n---\n")
-
-print("VECTOR TAGS")
-for index, score in vector_results_tags:
-    print(f"Document index: {index}, Score: {score}\n{stringified_tags[index]}\n---\n")
\ No newline at end of file
+        tags.update(zip(missing, retried))
+        return collect_groups(groups, [tags[i] for i in range(len(groups))])
+
+def request_key(doc):
+    # Hash of the single-document request, which covers the model, prompt and schema,
+    # so any change to them misses the cache
+    return hashlib.sha256(json.dumps(tagging_request([doc]), sort_keys=True).encode()).hexdigest()
+
+def classical_to_llm_tags(tags):
+    return {
+        'document': tags['document'],
+        'entities': [text for text, _ in tags['entities']],
+        'keywords': tags['keywords'],
+        'topics': [word for _, topic in tags['topics'] for word in re.findall(r'"([^"]+)"', topic)],
+        'categories': []
+    }
+
+def tag_documents(documents, use_batch=True, use_cache=True):
+    # Use the free classical tags where they are confident and only send the rest to the LLM
+    tags = [None] * len(documents)
+    needs_llm = []
+    classical = [classical_to_llm_tags(classical_tags) for classical_tags in classical_nlp_tagging(documents)]
+    for i, classical_tags in enumerate(classical):
+        if len(classical_tags['entities']) + len(classical_tags['keywords']) >= MIN_CLASSICAL_SCORE:
+            tags[i] = classical_tags
+            continue
+        cached = cache.get(request_key(documents[i])) if use_cache else None
+        if cached is not None:
+            tags[i] = cached
+        else:
+            needs_llm.append(i)
+    print(f"Sending {len(needs_llm)}/{len(documents)} documents to the LLM")
+
+    if needs_llm:
+        llm_documents = [documents[i] for i in needs_llm]
+        if use_batch:
+            llm_tags = asyncio.run(llm_tagging_batch(llm_documents))
+        else:
+            llm_tags = asyncio.run(llm_tagging(llm_documents))
+        # Tagged groups are already cached; documents whose group failed fall back to
+        # their classical tags and are sent to the LLM again on the next run
+        for i, doc_tags in zip(needs_llm, llm_tags):
+            tags[i] = doc_tags if doc_tags is not None else classical[i]
+    return tags
+
+def encode_cached(model, model_name, texts, use_cache=True):
+    # Keyed on the model name since the model object does not reliably expose it
+    keys = [f"{model_name}:{hashlib.sha1(text.encode()).hexdigest()}" for text in texts]
+    missing = [i for i, key in enumerate(keys) if not use_cache or key not in embedding_cache]
+    if missing:
+        # Encode all misses in one batched call
+        encoded = model.encode(
+            [texts[i] for i in missing],
+            batch_size=256,
+            convert_to_tensor=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+        for i, embedding in zip(missing, encoded):
+            embedding_cache[keys[i]] = embedding.float().cpu().numpy()
+    embeddings = torch.from_numpy(np.stack([embedding_cache[key] for key in keys]))
+    return embeddings.to(device=model.device, dtype=torch.float16 if model.device.type == 'cuda' else torch.float32)
+
+def flatten_tags(tags):
+    # Document text followed by its tags, as plain space-separated words
+    return " ".join([tags['document']] + tags['entities'] + tags['keywords'] + tags['topics'] + tags['categories'])
+
+def build_bm25(corpora):
+    # One index over all corpora concatenated, so they share a single tokenization
+    # pass and IDF vector; bm25s precomputes the sparse score matrix. Because the
+    # IDF and average document length are corpus-wide, each corpus is scored against
+    # the statistics of all of them: tag strings repeat their document text, so the
+    # documents-only rankings are no longer independent of the tags
+    retriever = bm25s.BM25()
+    documents = [doc for corpus in corpora for doc in corpus]
+    retriever.index(bm25s.tokenize(documents, stopwords="en", stemmer=stemmer, show_progress=False), show_progress=False)
+    # Layout of bm25s's internal score arrays, checked against get_scores on the pinned version
+    scores = retriever.scores
+    score_matrix = scipy.sparse.csc_matrix(
+        (scores["data"], scores["indices"], scores["indptr"]),
+        shape=(scores["num_docs"], len(scores["indptr"]) - 1)
+    ).T.tocsr()
+    return retriever, score_matrix
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    indices = np.argpartition(-scores, k - 1)[:k]
+    return indices[np.argsort(-scores[indices])]
+
+def bm25_search(retriever, score_matrix, corpora, queries, k=5):
+    # Score all queries in one sparse matmul of query term counts against the
+    # precomputed (vocab x docs) score matrix, then split the columns per corpus
+    # and return the top k results of every corpus for each query
+    query_tokens = bm25s.tokenize(queries, stopwords="en", stemmer=stemmer, return_ids=False, show_progress=False)
+    rows, cols = [], []
+    for row, tokens in enumerate(query_tokens):
+        for token in tokens:
+            if token in retriever.vocab_dict:
+                rows.append(row)
+                cols.append(retriever.vocab_dict[token])
+    query_matrix = scipy.sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+        shape=(len(queries), score_matrix.shape[0])
+    )
+    scores = (query_matrix @ score_matrix).toarray()
+
+    results = [[] for _ in queries]
+    offset = 0
+    for corpus in corpora:
+        corpus_scores = scores[:, offset:offset + len(corpus)]
+        for query_results, row in zip(results, corpus_scores):
+            query_results.append([(index, corpus[index], row[index]) for index in top_k(row, k)])
+        offset += len(corpus)
+    return results
+
+def vector_search(document_embeddings, query_embeddings, k=5):
+    # Embeddings are normalized at encode time, so cosine similarity for a batch
+    # of queries is a single matmul; returns the top k results for each query
+    scores = query_embeddings @ document_embeddings.T
+    # Select the top k on the device so only k scores per query are copied to the host
+    values, indices = torch.topk(scores, k=min(k, scores.shape[-1]), dim=-1)
+    return [
+        list(zip(query_indices, query_values))
+        for query_indices, query_values in zip(indices.cpu().tolist(), values.cpu().tolist())
+    ]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--small", action="store_true", help="Tag with concurrent chat completions instead of the Batch API")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore cached LLM tags and embeddings and recompute them")
+    args = parser.parse_args()
+
+    # Stream the dataset and stop as soon as enough complete rows are collected
+    ds = load_dataset("okite97/news-data", split="train", streaming=True)
+    documents = []
+    for row in ds:
+        if row['Title'] is not None and row['Excerpt'] is not None:
+            documents.append(row['Title'] + ' ' + row['Excerpt'])
+            if len(documents) == MAX_DOCS:
+                break
+
+    chatgpt_tags = tag_documents(documents, use_batch=not args.small, use_cache=not args.no_cache)
+    stringified_tags = [flatten_tags(t) for t in chatgpt_tags]
+
+    query = "Football news"
+
+    # Shared index: the documents-only baseline uses IDF and average length computed over the tag strings too
+    retriever, score_matrix = build_bm25([documents, stringified_tags])
+    bm25_results_docs, bm25_results_tags = bm25_search(retriever, score_matrix, [documents, stringified_tags], [query])[0]
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = SentenceTransformer(EMBEDDING_MODEL, device=device)
+    if device == 'cuda':
+        # Half precision halves memory bandwidth and uses the tensor cores
+        model.half()
+
+    # Encode everything together, reusing cached embeddings, and split the result
+    embeddings = encode_cached(model, EMBEDDING_MODEL, documents + stringified_tags + [query], use_cache=not args.no_cache)
+    doc_embeddings = embeddings[:len(documents)]
+    tag_embeddings = embeddings[len(documents):-1]
+    query_embeddings = embeddings[-1:]
+
+    vector_results_docs = vector_search(doc_embeddings, query_embeddings)[0]
+    vector_results_tags = vector_search(tag_embeddings, query_embeddings)[0]
+
+    print("BM25 NO TAGS")
+    for index, doc, score in bm25_results_docs:
+        print(f"Document index: {index}, Score: {score}\n{doc}\n---\n")
+
+    print("BM25 TAGS")
+    for index, doc, score in bm25_results_tags:
+        print(f"Document index: {index}, Score: {score}\n{doc}\n---\n")
+
+    print("VECTOR NO TAGS")
+    for index, score in vector_results_docs:
+        print(f"Document index: {index}, Score: {score}\n{documents[index]}\n---\n")
+
+    print("VECTOR TAGS")
+    for index, score in vector_results_tags:
+        print(f"Document index: {index}, Score: {score}\n{stringified_tags[index]}\n---\n")
+
+if __name__ == "__main__":
+    main()